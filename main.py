@@ -1,24 +1,33 @@
 import asyncio
 import base64
-import hashlib
 import logging
 import os
+import tempfile
 import zipfile
-from asyncio import to_thread
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from functools import lru_cache
 from functools import partial
 from importlib import import_module
-from io import BytesIO
-from time import mktime
+from time import monotonic
+from time import time
+from types import MappingProxyType
 from types import SimpleNamespace
+from typing import IO
+from typing import Any
 from typing import AsyncGenerator
+from typing import Callable
+from typing import Coroutine
+from typing import Literal
 from urllib.parse import urlparse
 from wsgiref.handlers import format_date_time
 
 import docker
 import httpx
+import orjson
 import yaml
+from blake3 import blake3
 from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import FastAPI
@@ -67,29 +76,67 @@ with open("database.yaml", "rt") as f:
     database = yaml.safe_load(f)
 
 
+semaphore = asyncio.Semaphore(100)
+
+
 async def online(clients: set) -> None:
-    message = {"event": {"topic": "online", "data": {"clients": len(clients)}}}
-    tasks = (asyncio.create_task(c.send_json(message)) for c in clients)
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    failed = {c for c, r in zip(clients, results) if isinstance(r, Exception)}
+    snapshot = list(clients)
+    message = orjson.dumps({"event": {"topic": "online", "data": {"clients": len(snapshot)}}}).decode()
+
+    async def send(client: WebSocket) -> bool:
+        async with semaphore:
+            try:
+                await asyncio.wait_for(client.send_text(message), timeout=2.0)
+            except asyncio.TimeoutError:
+                logger.warning("Closing client that did not accept the online broadcast in time.")
+                try:
+                    await asyncio.wait_for(client.close(), timeout=2.0)
+                except Exception:
+                    pass
+            except (WebSocketDisconnect, RuntimeError, OSError):
+                return False
+            return True
+
+    results = await asyncio.gather(*(send(c) for c in snapshot), return_exceptions=True)
+    failed = {c for c, r in zip(snapshot, results) if r is False}
     clients.difference_update(failed)
 
 
 broadcast = SimpleNamespace(online=online)
 
+background: set[asyncio.Task] = set()
+
+
+def spawn(coroutine: Coroutine[Any, Any, None]) -> None:
+    task = asyncio.create_task(coroutine)
+    background.add(task)
+    task.add_done_callback(background.discard)
+
+
+ping = orjson.dumps({"command": "ping"}).decode()
+
+executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="rpc")
+
+
+@lru_cache(maxsize=None)
+def procedure(method: str) -> Callable[..., Any]:
+    if not isinstance(method, str) or not method.isidentifier():
+        raise ValueError(f"Invalid procedure name: {method!r}")
+    return import_module(f"procedures.{method}").run
+
 
 async def add(websocket: WebSocket) -> None:
     async with lock:
         clients.add(websocket)
         logger.info(f"Client connected. Total clients: {len(clients)}")
-        await broadcast.online(clients)
+        spawn(broadcast.online(clients))
 
 
 async def disconnect(websocket: WebSocket) -> None:
     async with lock:
         clients.discard(websocket)
         logger.info(f"Client disconnected. Total clients: {len(clients)}")
-        await broadcast.online(clients)
+        spawn(broadcast.online(clients))
 
 
 @app.get("/favicon.ico")
@@ -108,22 +155,23 @@ async def websocket(websocket: WebSocket) -> None:
             while True:
                 try:
                     await asyncio.sleep(10)
-                    await websocket.send_json({"command": "ping"})
+                    await websocket.send_text(ping)
                 except (WebSocketDisconnect, asyncio.TimeoutError):
                     break
 
         async def relay() -> None:
             try:
-                async for message in websocket.iter_json():
-                    match message:
+                async for message in websocket.iter_text():
+                    match orjson.loads(message):
                         case {"rpc": {"request": {"id": id, "method": method, "arguments": arguments}}}:
                             response = {"rpc": {"response": {"id": id}}}
                             try:
-                                module = import_module(f"procedures.{method}")
+                                run = procedure(method)
                                 arguments = dict(arguments) if isinstance(arguments, (dict, list)) else {}
-                                func = partial(module.run, **arguments)
-                                result = await to_thread(func)
+                                func = partial(run, **arguments)
+                                result = await asyncio.get_running_loop().run_in_executor(executor, func)
                                 response["rpc"]["response"]["result"] = result
+                                payload = orjson.dumps(response, option=orjson.OPT_NON_STR_KEYS)
 
                                 logger.info(
                                     f"Successfully executed {method} with arguments: {arguments} "
@@ -135,9 +183,10 @@ async def websocket(websocket: WebSocket) -> None:
                                     exc_info=True,
                                 )
 
-                                response["rpc"]["response"]["error"] = str(exc)
+                                response["rpc"]["response"] = {"id": id, "error": str(exc)}
+                                payload = orjson.dumps(response, option=orjson.OPT_NON_STR_KEYS)
 
-                            await websocket.send_json(response)
+                            await websocket.send_text(payload.decode())
                         case _:
                             pass
             except WebSocketDisconnect:
@@ -157,6 +206,8 @@ async def websocket(websocket: WebSocket) -> None:
 
 
 redis = None
+http = None
+http1 = None
 client = docker.from_env()
 container = client.containers.get("redis")
 hostname = container.attrs["Config"]["Hostname"]
@@ -164,17 +215,38 @@ hostname = container.attrs["Config"]["Hostname"]
 
 @app.on_event("startup")
 async def startup_event():
-    global redis
+    global redis, http, http1
     redis = Redis(host=hostname, port=6379, decode_responses=False)
     await redis.ping()
 
+    http = httpx.AsyncClient(
+        follow_redirects=True,
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_connections=50),
+    )
+
+    http1 = httpx.AsyncClient(
+        follow_redirects=True,
+        timeout=30,
+        limits=httpx.Limits(max_connections=50),
+    )
+
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    global redis
+    global redis, http, http1
     if redis:
         await redis.close()
 
+    if http:
+        await http.aclose()
+
+    if http1:
+        await http1.aclose()
+
+    executor.shutdown(wait=False, cancel_futures=True)
+
 
 async def get_redis() -> Redis:
     if not redis:
@@ -182,72 +254,228 @@ async def get_redis() -> Redis:
     return redis
 
 
+async def get_http() -> httpx.AsyncClient:
+    if not http:
+        raise RuntimeError("HTTP client is not initialized.")
+    return http
+
+
+async def get_http1() -> httpx.AsyncClient:
+    if not http1:
+        raise RuntimeError("HTTP/1.1 client is not initialized.")
+    return http1
+
+
+class Cache:
+    def __init__(self, entries: int, size: int) -> None:
+        self.entries = entries
+        self.size = size
+        self.used = 0
+        self.items: OrderedDict[tuple[str, str], tuple[float, tuple[bytes | memoryview, str, str]]] = OrderedDict()
+
+    def get(self, key: tuple[str, str]) -> tuple[bytes | memoryview, str, str] | None:
+        item = self.items.get(key)
+        if item is None:
+            return None
+
+        deadline, value = item
+        if deadline < monotonic():
+            self.discard(key)
+            return None
+
+        self.items.move_to_end(key)
+        return value
+
+    def put(self, key: tuple[str, str], value: tuple[bytes | memoryview, str, str], ttl: timedelta) -> None:
+        self.discard(key)
+
+        size = len(value[0])
+        if size > self.size:
+            return
+
+        self.items[key] = (monotonic() + ttl.total_seconds(), value)
+        self.used += size
+
+        while len(self.items) > self.entries or self.used > self.size:
+            _, (_, (data, _, _)) = self.items.popitem(last=False)
+            self.used -= len(data)
+
+    def discard(self, key: tuple[str, str]) -> None:
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.used -= len(item[1][0])
+
+    def clear(self) -> None:
+        self.items.clear()
+        self.used = 0
+
+
+cache = Cache(entries=64, size=256 * 1024 * 1024)
+
+
+def extract(archive: IO[bytes], filename: str) -> list[tuple[str, bytes, str]]:
+    entries = []
+    with zipfile.ZipFile(archive) as zf:
+        for name in zf.namelist():
+            h = blake3()
+            buffer = bytearray()
+            try:
+                with zf.open(name) as fh:
+                    while chunk := fh.read(65536):
+                        h.update(chunk)
+                        buffer.extend(chunk)
+            except Exception as exc:
+                if name == filename:
+                    raise
+
+                logger.warning(f"Skipping {name}: {exc}")
+                continue
+
+            entries.append((name, bytes(buffer), base64.b64encode(h.digest()).decode()))
+
+    return entries
+
+
+async def consume(response: httpx.Response) -> tuple[memoryview, str]:
+    h = blake3()
+    buffer = bytearray()
+    async for chunk in response.aiter_bytes(65536):
+        h.update(chunk)
+        buffer.extend(chunk)
+
+    return memoryview(buffer), base64.b64encode(h.digest()).decode()
+
+
+async def fetch(
+    http: httpx.AsyncClient,
+    http1: httpx.AsyncClient,
+    url: str,
+    parts: int = 4,
+    threshold: int = 8 * 1024 * 1024,
+) -> tuple[memoryview, str]:
+    async with http1.stream("GET", url, headers={"Range": "bytes=0-0"}) as probe:
+        probe.raise_for_status()
+
+        if probe.status_code != status.HTTP_206_PARTIAL_CONTENT:
+            return await consume(probe)
+
+        total = probe.headers.get("Content-Range", "").rpartition("/")[-1]
+        target = probe.url
+
+    if not total.isdigit() or int(total) < threshold:
+        async with http.stream("GET", url) as response:
+            response.raise_for_status()
+            return await consume(response)
+
+    size = int(total)
+    step = -(-size // parts)
+    view = memoryview(bytearray(size))
+
+    async def part(start: int, end: int) -> None:
+        async with http1.stream("GET", target, headers={"Range": f"bytes={start}-{end}"}) as response:
+            response.raise_for_status()
+            if response.status_code != status.HTTP_206_PARTIAL_CONTENT:
+                raise RuntimeError(f"Unexpected response for bytes {start}-{end} of {url}: {response.status_code}")
+
+            offset = start
+            async for chunk in response.aiter_bytes(65536):
+                if offset + len(chunk) > end + 1:
+                    raise RuntimeError(f"Too many bytes for bytes {start}-{end} of {url}")
+                view[offset : offset + len(chunk)] = chunk
+                offset += len(chunk)
+
+            if offset != end + 1:
+                raise RuntimeError(f"Too few bytes for bytes {start}-{end} of {url}: got {offset - start}")
+
+    async with asyncio.TaskGroup() as group:
+        for start in range(0, size, step):
+            group.create_task(part(start, min(start + step, size) - 1))
+
+    h = await asyncio.to_thread(blake3, view)
+    return view, base64.b64encode(h.digest()).decode()
+
+
+async def etag(redis: Redis, url: str, filename: str) -> str | None:
+    if result := cache.get((url, filename)):
+        return result[1]
+
+    namespace = url.split("://", 1)[-1]
+    hash = await redis.hget(f"{namespace}:{filename}", "hash")
+    return hash.decode() if hash else None
+
+
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
 async def download(
     redis: Redis,
+    http: httpx.AsyncClient,
+    http1: httpx.AsyncClient,
     url: str,
     filename: str,
     ttl: timedelta = timedelta(days=365),
-) -> tuple[AsyncGenerator[bytes, None], str] | None:
-    namespace = url.split("://", 1)[-1]
-
-    def key(parts: tuple[str, ...]) -> str:
-        return ":".join(parts)
+) -> tuple[bytes | memoryview, str, str] | None:
+    if result := cache.get((url, filename)):
+        return result
 
-    async with redis.pipeline(transaction=True) as pipe:
-        pipe.get(key((namespace, filename, "content")))
-        pipe.get(key((namespace, filename, "hash")))
-        data, hash = await pipe.execute()
+    namespace = url.split("://", 1)[-1]
 
-    if isinstance(data, bytes) and isinstance(hash, bytes) and data.strip() and hash.strip():
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hmget(f"{namespace}:{filename}", "content", "hash", "modified")
+        pipe.pttl(f"{namespace}:{filename}")
+        fields, remaining = await pipe.execute()
 
-        async def stream() -> AsyncGenerator[bytes, None]:
-            yield data
+    match fields:
+        case [bytes() as data, bytes() as hash, bytes() as modified] if data and hash.strip() and modified.strip():
+            result = (data, hash.decode(), modified.decode())
+            cache.put((url, filename), result, timedelta(milliseconds=remaining) if remaining > 0 else ttl)
+            return result
 
-        return stream(), hash.decode()
+    ext = os.path.splitext(urlparse(url).path)[-1].lower()
+    modified = format_date_time(time())
 
-    async with httpx.AsyncClient(follow_redirects=True) as client:
-        response = await client.get(url)
-        response.raise_for_status()
+    async with redis.pipeline(transaction=False) as pipe:
 
-        ext = os.path.splitext(urlparse(url).path)[-1].lower()
+        def store(pipe, prefix: str, content: bytes | memoryview, hash: str) -> None:
+            pipe.hset(prefix, mapping={"content": content, "hash": hash, "modified": modified})
+            pipe.expire(prefix, ttl)
+            pipe.delete(f"{prefix}:content", f"{prefix}:hash", f"{prefix}:modified")
 
-        async with redis.pipeline(transaction=True) as pipe:
+        match ext:
+            case ".zip":
+                async with http.stream("GET", url) as response:
+                    response.raise_for_status()
 
-            def store(pipe, key_parts: tuple[str, ...], content: bytes, hash: str) -> None:
-                prefix = key(key_parts)
-                pipe.set(key((prefix, "hash")), hash, ex=ttl)
-                pipe.set(key((prefix, "content")), content, ex=ttl)
+                    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+                        async for chunk in response.aiter_bytes(65536):
+                            spool.write(chunk)
+                        spool.seek(0)
 
-            match ext:
-                case ".zip":
-                    with zipfile.ZipFile(BytesIO(response.content)) as zf:
-                        result = None
-                        for name in zf.namelist():
-                            content = zf.read(name)
-                            content_hash = base64.b64encode(hashlib.sha256(content).digest()).decode()
-                            store(pipe, (namespace, name), content, content_hash)
-                            if name == filename:
+                        entries = await asyncio.to_thread(extract, spool, filename)
 
-                                async def stream():
-                                    yield content
+                result = None
+                for name, content, content_hash in entries:
+                    store(pipe, f"{namespace}:{name}", content, content_hash)
+                    if len(pipe) >= 500:
+                        await pipe.execute()
+                    if name == filename:
+                        result = (content, content_hash)
 
-                                result = (stream(), content_hash)
+                await pipe.execute()
 
-                        await pipe.execute()
-                        return result
+                if result is None:
+                    return None
 
-                case _:
-                    data = response.content
-                    content_hash = base64.b64encode(hashlib.sha256(data).digest()).decode()
-                    store(pipe, (namespace, filename), data, content_hash)
+                content, content_hash = result
+                cache.put((url, filename), (content, content_hash, modified), ttl)
+                return content, content_hash, modified
 
-                    await pipe.execute()
+            case _:
+                data, content_hash = await fetch(http, http1, url)
+                store(pipe, f"{namespace}:{filename}", data, content_hash)
 
-                    async def stream():
-                        yield data
+                await pipe.execute()
 
-                    return stream(), content_hash
+                cache.put((url, filename), (data, content_hash, modified), ttl)
+                return data, content_hash, modified
 
 
 @app.head("/")
@@ -256,53 +484,54 @@ async def healthcheck(redis: Redis = Depends(get_redis)):
     return Response(status_code=status.HTTP_200_OK)
 
 
-@app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    artifacts = database.get("artifacts", [])
+index_html = templates.get_template("index.html").render(artifacts=database.get("artifacts", [])).encode()
 
-    return templates.TemplateResponse(
-        request=request,
-        name="index.html",
-        context={"artifacts": artifacts},
-    )
+
+@app.get("/", response_class=HTMLResponse)
+async def index():
+    return HTMLResponse(content=index_html)
 
 
 @app.get("/flush")
 async def flush(redis: Redis = Depends(get_redis)):
     await redis.flushall()
+    cache.clear()
     return Response(status_code=status.HTTP_200_OK)
 
 
 router = APIRouter(prefix="/play/{runtime}/{organization}/{repository}/{release}/{resolution}")
 
 
-@router.get("/", response_class=HTMLResponse)
-async def play(
-    runtime: str,
-    organization: str,
-    repository: str,
-    release: str,
-    resolution: str,
-    request: Request,
-):
-    mapping = {
+Resolution = Literal["480p", "720p", "1080p"]
+
+resolutions = MappingProxyType(
+    {
         "480p": (854, 480),
         "720p": (1280, 720),
         "1080p": (1920, 1080),
     }
-    width, height = mapping[resolution]
+)
+
+
+@lru_cache(maxsize=256)
+def render(runtime: str, organization: str, repository: str, release: str, resolution: Resolution) -> bytes:
+    width, height = resolutions[resolution]
 
     url = f"/play/{runtime}/{organization}/{repository}/{release}/{resolution}/"
 
-    return templates.TemplateResponse(
-        request=request,
-        name="play.html",
-        context={
-            "url": url,
-            "width": width,
-            "height": height,
-        },
-    )
+    template = templates.get_template("play.html")
+    return template.render(url=url, width=width, height=height).encode()
+
+
+@router.get("/", response_class=HTMLResponse)
+async def play(
+    runtime: str,
+    organization: str,
+    repository: str,
+    release: str,
+    resolution: Resolution,
+):
+    return HTMLResponse(content=render(runtime, organization, repository, release, resolution))
 
 
 @router.get("/{filename}")
@@ -311,9 +540,12 @@ async def dynamic(
     organization: str,
     repository: str,
     release: str,
-    resolution: str,
+    resolution: Resolution,
     filename: str,
+    request: Request,
     redis: Redis = Depends(get_redis),
+    http: httpx.AsyncClient = Depends(get_http),
+    http1: httpx.AsyncClient = Depends(get_http1),
 ):
     match filename:
         case "bundle.7z":
@@ -328,28 +560,47 @@ async def dynamic(
         case _:
             raise HTTPException(status_code=404)
 
-    result = await download(redis, url, filename)
+    duration = timedelta(days=365).total_seconds()
+    cache_control = f"public, max-age={int(duration)}, immutable"
+
+    if tags := request.headers.get("If-None-Match"):
+        if hash := await etag(redis, url, filename):
+            if {"*", hash} & {tag.strip().removeprefix("W/").strip('"') for tag in tags.split(",")}:
+                return Response(
+                    status_code=status.HTTP_304_NOT_MODIFIED,
+                    headers={"Cache-Control": cache_control, "ETag": hash},
+                )
+
+    result = await download(redis, http, http1, url, filename)
     if result is None:
         raise HTTPException(status_code=404)
 
-    content, hash = result
-
-    now = datetime.utcnow()
-    timestamp = mktime(now.timetuple())
-    modified = format_date_time(timestamp)
+    content, hash, modified = result
 
-    duration = timedelta(days=365).total_seconds()
     headers = {
-        "Cache-Control": f"public, max-age={int(duration)}, immutable",
+        "Cache-Control": cache_control,
         "Content-Disposition": f'inline; filename="{filename}"',
         "Last-Modified": modified,
         "ETag": hash,
     }
 
+    size = len(content)
+    if size <= 4 * 1024 * 1024:
+        return Response(
+            content=content,
+            media_type=media_type,
+            headers=headers,
+        )
+
+    async def stream() -> AsyncGenerator[bytes, None]:
+        view = memoryview(content)
+        for offset in range(0, size, 1024 * 1024):
+            yield view[offset : offset + 1024 * 1024]
+
     return StreamingResponse(
-        content=content,
+        content=stream(),
         media_type=media_type,
-        headers=headers,
+        headers={**headers, "Content-Length": str(size)},
     )
 
 